@@ -1,38 +1,136 @@
 # ...existing code...
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, Request, request, jsonify, Response, send_from_directory, stream_with_context
+import hashlib
 import os
+import shutil
+import tempfile
+import threading
 import uuid
-from tools.llm.llm_client import get_llm_client
-from tools.data_ingestion.parser import handle_file_upload
-from tools.context_management.context_handler import read_context, write_context, update_context_from_llm
+from urllib.parse import quote, unquote
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, Tuple
+import orjson
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from tools.data_ingestion.parser import UPLOAD_CHUNK_SIZE, allowed_file, save_upload_stream, process_dataset
+from tools.data_ingestion.chunked_upload import init_upload, save_chunk, received_chunks, read_manifest, complete_upload
+from tools.context_management.context_handler import read_chat_history, read_context_cached, write_context, update_context_from_llm
 from tools.llm.orchestrator import process_user_message, cotas_generate_insights
+from tools.streaming.sse import stream_events, gzip_events
+from tools.task_queue.jobs import submit_job, job_status, run_blocking
+from tools.serialization.json_provider import OrjsonProvider
+
+BASE_STORAGE = "storage"
+# Multipart file parts are spooled here, on the same filesystem as the sessions,
+# so save_upload_stream can hard-link them into place instead of copying them
+UPLOAD_SPOOL = os.path.join(BASE_STORAGE, "_spool")
+os.makedirs(UPLOAD_SPOOL, exist_ok=True)
+
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL, buffering=UPLOAD_CHUNK_SIZE)
 
-# instantiate central LLM client (configured via env: LLM_BACKEND, OLLAMA_URL, OLLAMA_MODEL)
-_llm_client = get_llm_client()
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
+app.json = OrjsonProvider(app)
 app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB max file size
 
-BASE_STORAGE = "storage"
+# Keep reverse proxies (nginx et al.) from buffering or transforming the event stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
+# Not a UUID, so _parse_sid keeps it unreachable from the API
+SESSION_TEMPLATE = "_template_session"
+
+# Session subdirectories that /download may serve from
+DOWNLOAD_KINDS = {"datasets", "scripts", "results"}
+# When set (e.g. "/_internal"), downloads are handed to nginx via X-Accel-Redirect
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+
+# Session ids already confirmed on disk; spares a stat() on every request
+_known_sessions = set()
+_known_sessions_lock = threading.Lock()
+
+
+# Central LLM client (configured via env: LLM_BACKEND, OLLAMA_URL, OLLAMA_MODEL), built on
+# first use so startup doesn't pay for a backend SDK that no route may ever touch
+@lru_cache(maxsize=1)
+def _get_llm_client():
+    from tools.llm.llm_client import get_llm_client
+    return get_llm_client()
 
 
 def _call_llm(prompt: str, max_tokens: int = 512, temperature: float = 0.0, stream: bool = False):
 
-    return _llm_client.generate(prompt=prompt, max_tokens=max_tokens, temperature=temperature, stream=stream)
+    return _get_llm_client().generate(prompt=prompt, max_tokens=max_tokens, temperature=temperature, stream=stream)
 
 
-def get_session_path(session_id: str) -> dict:
+# Read-only so the cached mapping can be shared safely between requests
+@lru_cache(maxsize=1024)
+def get_session_path(session_id: str) -> MappingProxyType:
     session_path = os.path.join(BASE_STORAGE, session_id)
-    return {
+    return MappingProxyType({
         "session": session_path,
         "datasets": os.path.join(session_path, "datasets"),
         "scripts": os.path.join(session_path, "scripts"),
         "results": os.path.join(session_path, "results"),
+        "uploads": os.path.join(session_path, "uploads"),
+        "jobs": os.path.join(session_path, "jobs"),
         "context": os.path.join(session_path, "context.json"),
         "dataset_metadata": os.path.join(session_path, "dataset_metadata.json"),
-        "chat_history": os.path.join(session_path, "chat_history.json"),
+        "chat_history": os.path.join(session_path, "chat_history.jsonl"),
         "cotas_log": os.path.join(session_path, "cotas_log.json"),
-    }
+    })
+
+
+# Pre-encoded bodies for the errors that broken or stale clients hit most often
+_ERROR_BODIES = {
+    "no_session": (orjson.dumps({"error": "session_id required"}), 400),
+    "malformed_session": (orjson.dumps({"error": "Malformed session_id"}), 400),
+    "unknown_session": (orjson.dumps({"error": "Invalid session_id"}), 404),
+}
+
+
+def _error_response(kind: str) -> Response:
+    body, status = _ERROR_BODIES[kind]
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _parse_sid(session_id) -> Optional[str]:
+    # Canonical UUID form, or None; rejects traversal like "../" before any FS access
+    try:
+        return str(uuid.UUID(session_id))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _valid_session(session_id: str) -> bool:
+    if session_id in _known_sessions:
+        return True
+    if not os.path.exists(get_session_path(session_id)["session"]):
+        return False
+    with _known_sessions_lock:
+        _known_sessions.add(session_id)
+    return True
+
+
+def _resolve_session(session_id) -> Tuple[Optional[str], Optional[MappingProxyType], Optional[Response]]:
+    # Shared by every session-scoped route: (canonical id, paths, None), or an error response
+    if not session_id:
+        return None, None, _error_response("no_session")
+    session_id = _parse_sid(session_id)
+    if session_id is None:
+        return None, None, _error_response("malformed_session")
+    if not _valid_session(session_id):
+        return None, None, _error_response("unknown_session")
+    return session_id, get_session_path(session_id), None
 
 
 def ensure_session_dirs(paths: dict):
@@ -42,20 +140,62 @@ def ensure_session_dirs(paths: dict):
     os.makedirs(paths["results"], exist_ok=True)
 
 
+def _link_or_copy(src: str, dst: str) -> None:
+    # Hard links are safe because write_context always replaces files rather than editing them,
+    # and the template has no chat history file for appends to modify
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _build_session_template() -> str:
+    # Pre-built empty session that create_session clones instead of building from scratch
+    paths = get_session_path(SESSION_TEMPLATE)
+    ensure_session_dirs(paths)
+    # No chat history file: it is appended to in place, so it must never be a shared hard link
+    write_context(paths["dataset_metadata"], {"datasets": []})
+    return paths["session"]
+
+
+_SESSION_TEMPLATE_PATH = _build_session_template()
+
+
+def _clone_session_template(paths, session_id: str) -> None:
+    # One threadpool hop for all of a new session's disk work; the template already
+    # carries the empty metadata file, so context.json is the only write
+    shutil.copytree(_SESSION_TEMPLATE_PATH, paths["session"], copy_function=_link_or_copy)
+    write_context(paths["context"], {"session_id": session_id, "history": []})
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    # JSON like every other API error, so the upload code can show the message
+    return jsonify({"error": "File too large"}), 413
+
+
+# index.html is fully static, so render it once instead of on every request
+_INDEX_HTML = app.jinja_env.get_template("index.html").render().encode("utf-8")
+_INDEX_ETAG = hashlib.blake2b(_INDEX_HTML, digest_size=16).hexdigest()
+
+
 @app.route("/")
 def home():
-    return render_template("index.html")
+    response = Response(_INDEX_HTML, mimetype="text/html")
+    response.set_etag(_INDEX_ETAG)
+    # Revalidate every load so a redeploy is picked up, but let unchanged pages 304
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 
 @app.route("/create-session", methods=["POST"])
 def create_session():
     session_id = str(uuid.uuid4())
     paths = get_session_path(session_id)
-    ensure_session_dirs(paths)
-
-    write_context(paths["context"], {"session_id": session_id, "history": []})
-    write_context(paths["dataset_metadata"], {"datasets": []})
-    write_context(paths["chat_history"], {"messages": []})
+    # Disk work goes through run_blocking so it can't stall other greenlets under gevent
+    run_blocking(_clone_session_template, paths, session_id)
+    with _known_sessions_lock:
+        _known_sessions.add(session_id)
 
     return jsonify({"session_id": session_id, "message": "Session created successfully"})
 
@@ -69,9 +209,9 @@ def chat():
     if not session_id or not user_message:
         return jsonify({"error": "session_id and message required"}), 400
 
-    paths = get_session_path(session_id)
-    if not os.path.exists(paths["session"]):
-        return jsonify({"error": "Invalid session_id"}), 404
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
 
     try:
         response = process_user_message(user_message, paths)
@@ -82,28 +222,140 @@ def chat():
 
 @app.route("/upload-file", methods=["POST"])
 def upload_file():
-    session_id = request.form.get("session_id")
-    file = request.files.get("file")
-
-    if not session_id or not file:
+    # Raw request bodies are copied straight to disk; multipart is kept for older clients
+    if request.mimetype == "multipart/form-data":
+        session_id = request.form.get("session_id")
+        file = request.files.get("file")
+        filename = file.filename if file else None
+        stream = file.stream if file else None
+    else:
+        session_id = request.args.get("session_id")
+        filename = unquote(request.headers.get("X-Filename", ""))
+        stream = request.stream
+
+    filename = secure_filename(filename or "")
+    if not session_id or not filename:
         return jsonify({"error": "session_id and file required"}), 400
+    if not allowed_file(filename):
+        return jsonify({"error": "Unsupported file type"}), 415
 
-    paths = get_session_path(session_id)
-    if not os.path.exists(paths["session"]):
-        return jsonify({"error": "Invalid session_id"}), 404
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
+
+    try:
+        file_path, size_bytes = save_upload_stream(stream, filename, paths["datasets"])
+        job_id = submit_job(paths["jobs"], process_dataset, file_path, paths["dataset_metadata"], paths["context"], size_bytes)
+        return jsonify({"message": "File uploaded, processing", "job_id": job_id, "status": "processing"}), 202
+    except RequestEntityTooLarge:
+        # Can be raised mid-stream; let it reach the 413 handler instead of becoming a
+        # 500, which the client would retry even though the upload can never succeed
+        raise
+    except Exception as e:
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+
+@app.route("/upload-file/init", methods=["POST"])
+def upload_file_init():
+    data = request.get_json()
+    session_id = data.get("session_id")
+    filename = secure_filename(data.get("filename", ""))
+    total_size = data.get("size")
+
+    if not session_id or not filename or not isinstance(total_size, int) or total_size < 0:
+        return jsonify({"error": "session_id, filename and size required"}), 400
+    if not allowed_file(filename):
+        return jsonify({"error": "Unsupported file type"}), 415
+    if total_size > app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify({"error": "File too large"}), 413
+
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
+
+    manifest = init_upload(paths["uploads"], filename, total_size)
+    return jsonify(manifest)
+
+
+@app.route("/upload-file/chunk", methods=["POST"])
+def upload_file_chunk():
+    session_id = request.args.get("session_id")
+    upload_id = request.headers.get("X-Upload-Id")
+    index = request.headers.get("X-Chunk-Index", type=int)
+
+    if not session_id or not upload_id or index is None:
+        return jsonify({"error": "session_id, X-Upload-Id and X-Chunk-Index required"}), 400
+
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
 
     try:
-        metadata = handle_file_upload(
-            file,
-            paths["datasets"],
-            paths["dataset_metadata"],
-            paths["context"],
-        )
-        return jsonify({"message": "File uploaded and processed", "metadata": metadata})
+        save_chunk(paths["uploads"], upload_id, index, request.stream)
+        return jsonify({"upload_id": upload_id, "chunk": index})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        return jsonify({"error": f"Chunk upload failed: {str(e)}"}), 500
+
+
+@app.route("/upload-file/status", methods=["GET"])
+def upload_file_status():
+    session_id = request.args.get("session_id")
+    upload_id = request.args.get("upload_id")
+
+    if not session_id or not upload_id:
+        return jsonify({"error": "session_id and upload_id required"}), 400
+
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
+
+    try:
+        manifest = read_manifest(paths["uploads"], upload_id)
+        return jsonify({**manifest, "received": received_chunks(paths["uploads"], upload_id)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+
+
+@app.route("/upload-file/complete", methods=["POST"])
+def upload_file_complete():
+    data = request.get_json()
+    session_id = data.get("session_id")
+    upload_id = data.get("upload_id")
+
+    if not session_id or not upload_id:
+        return jsonify({"error": "session_id and upload_id required"}), 400
+
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
+
+    try:
+        file_path, size_bytes = run_blocking(complete_upload, paths["uploads"], upload_id, paths["datasets"])
+        job_id = submit_job(paths["jobs"], process_dataset, file_path, paths["dataset_metadata"], paths["context"], size_bytes)
+        return jsonify({"message": "File uploaded, processing", "job_id": job_id, "status": "processing"}), 202
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
 
+@app.route("/job-status/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    session_id = request.args.get("session_id")
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
+
+    status = run_blocking(job_status, paths["jobs"], job_id)
+    if status is None:
+        return jsonify({"error": "Unknown job_id"}), 404
+    return jsonify(status)
+
+
 @app.route("/generate-insights", methods=["POST"])
 def generate_insights():
     data = request.get_json()
@@ -111,51 +363,91 @@ def generate_insights():
     user_goal = data.get("goal", "Perform comprehensive data analysis")
     max_loops = data.get("max_loops", 15)
 
-    if not session_id:
-        return jsonify({"error": "session_id required"}), 400
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
 
-    paths = get_session_path(session_id)
-    if not os.path.exists(paths["session"]):
-        return jsonify({"error": "Invalid session_id"}), 404
+    cancel = threading.Event()
+    updates = cotas_generate_insights(paths, user_goal, max_loops, cancel=cancel)
+    events = stream_events(updates, stop=cancel)
+    headers = SSE_HEADERS
+    if "gzip" in request.accept_encodings:
+        events = gzip_events(events)
+        headers = {**SSE_HEADERS, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers=headers)
+
+
+@app.route("/download/<session_id>/<kind>/<name>", methods=["GET"])
+def download(session_id, kind, name):
+    if kind not in DOWNLOAD_KINDS:
+        return jsonify({"error": "Unknown download kind"}), 404
 
-    def generate():
+    session_id, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
+
+    directory = os.path.abspath(paths[kind])
+    if safe_join(directory, name) is None:
+        return jsonify({"error": "Invalid file name"}), 400
+
+    if X_ACCEL_PREFIX:
+        # nginx streams the file itself; Python never touches the bytes
+        response = Response(mimetype="application/octet-stream")
+        response.headers["X-Accel-Redirect"] = f"{X_ACCEL_PREFIX}/{quote(session_id)}/{kind}/{quote(name)}"
+        response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(name)}"
+        return response
+
+    return send_from_directory(directory, name, as_attachment=True)
+
+
+def _file_etag(*files: str) -> str:
+    # mtime+size is enough: write_context replaces files and chat appends always grow them
+    parts = []
+    for path in files:
         try:
-            for update in cotas_generate_insights(paths, user_goal, max_loops):
-                yield f"data: {update}\n\n"
-        except Exception as e:
-            yield f"data: {{\"error\": \"Analysis failed: {str(e)}\"}}\n\n"
+            st = os.stat(path)
+            parts.append(f"{st.st_mtime_ns:x}-{st.st_size:x}")
+        except OSError:
+            parts.append("0")
+    return ".".join(parts)
+
 
-    return Response(generate(), mimetype="text/event-stream")
+def _conditional_json(etag: str, load) -> Response:
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(load())
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 @app.route("/get-context", methods=["GET"])
 def get_context():
     session_id = request.args.get("session_id")
-    if not session_id:
-        return jsonify({"error": "session_id required"}), 400
-
-    paths = get_session_path(session_id)
-    if not os.path.exists(paths["session"]):
-        return jsonify({"error": "Invalid session_id"}), 404
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
 
-    context = read_context(paths["context"])
-    metadata = read_context(paths["dataset_metadata"])
-    return jsonify({"context": context, "dataset_metadata": metadata})
+    etag = run_blocking(_file_etag, paths["context"], paths["dataset_metadata"])
+    return _conditional_json(etag, lambda: {
+        "context": run_blocking(read_context_cached, paths["context"]),
+        "dataset_metadata": run_blocking(read_context_cached, paths["dataset_metadata"]),
+    })
 
 
 @app.route("/get-chat-history", methods=["GET"])
 def get_chat_history():
     session_id = request.args.get("session_id")
-    if not session_id:
-        return jsonify({"error": "session_id required"}), 400
-
-    paths = get_session_path(session_id)
-    if not os.path.exists(paths["session"]):
-        return jsonify({"error": "Invalid session_id"}), 404
+    _, paths, error = _resolve_session(session_id)
+    if error is not None:
+        return error
 
-    chat_history = read_context(paths["chat_history"])
-    return jsonify(chat_history)
+    etag = run_blocking(_file_etag, paths["chat_history"])
+    return _conditional_json(etag, lambda: run_blocking(read_chat_history, paths["chat_history"]))
 
 
 if __name__ == "__main__":
-    app.run(debug=True, threaded=True, port=5000)
\ No newline at end of file
+    # Development only; debug mode follows FLASK_DEBUG instead of being forced on
+    app.run(threaded=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,12 @@
+# Picked up automatically by `gunicorn wsgi:application` from the project root.
+# Override the worker count per host with WEB_CONCURRENCY.
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+worker_class = "gevent"
+# Each gevent worker multiplexes many requests, so one per core keeps every core busy
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = 1000
+# SSE streams stay open for the whole CoTAS run; don't let the arbiter kill them
+timeout = 0
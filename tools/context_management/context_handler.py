@@ -1,67 +1,236 @@
-import json
 import os
+import tempfile
+import threading
 import time
-from typing import Any, Dict, List
+from collections import defaultdict, deque
+from typing import Any, Callable, Dict, List
+
+import orjson
+from cachetools import TTLCache
+
+from tools.serialization.json_provider import ORJSON_OPTIONS
+
+
+def _native_lock_types():
+    # These locks are taken both from greenlets and from the gevent hub's native threadpool
+    # (run_blocking), so under monkey-patching they must be the unpatched primitives. No
+    # critical section below yields, so a greenlet never holds one across a switch.
+    try:
+        from gevent import monkey
+    except ImportError:
+        return threading.Lock, threading.RLock
+    return monkey.get_original("_thread", "allocate_lock"), monkey.get_original("_thread", "RLock")
+
+
+_Lock, _RLock = _native_lock_types()
+
+# path -> (st_mtime_ns, st_size, parsed data); shared by read-only callers
+_read_cache = TTLCache(maxsize=1024, ttl=30)
+_read_cache_lock = _Lock()
+
+# Context history kept inline in context.json; the rest is in <context>.archive.jsonl
+CONTEXT_HISTORY_LIMIT = 50
+CONTEXT_ARCHIVE_SUFFIX = ".archive.jsonl"
+
+# Chat history is append-only JSONL; only the newest messages are ever read back
+CHAT_HISTORY_LIMIT = 100
+# Past this size the file is rewritten down to its last CHAT_HISTORY_LIMIT lines
+CHAT_HISTORY_COMPACT_BYTES = 1 << 20
+
+# One re-entrant lock per session directory serializes read-modify-write cycles
+_session_locks = defaultdict(_RLock)
+_session_locks_lock = _Lock()
+
+# mkstemp creates files 0600; read once at import (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def session_lock(path: str) -> threading.RLock:
+    key = os.path.dirname(os.path.abspath(path))
+    with _session_locks_lock:
+        return _session_locks[key]
 
 def read_context(path: str) -> Dict[str, Any]:
     if not os.path.exists(path):
         return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        # orjson parses straight from bytes, several times faster than the json module
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except Exception:
         return {}
 
-def write_context(path: str, data: Dict[str, Any]) -> None:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+# Like read_context, but reuses the last parse while the file is unchanged.
+# The returned dict is shared between callers and must not be mutated.
+def read_context_cached(path: str) -> Dict[str, Any]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+
+    with _read_cache_lock:
+        cached = _read_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    data = read_context(path)
+    with _read_cache_lock:
+        _read_cache[path] = (st.st_mtime_ns, st.st_size, data)
+    return data
+
+def _atomic_write(path: str, payload: bytes, fsync: bool = False) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    # Write to a temp file and rename so readers never see a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        # Give the file the permissions a plain open() would have
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        with session_lock(path):
+            os.replace(tmp_path, path)
+            with _read_cache_lock:
+                _read_cache.pop(path, None)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def write_context(path: str, data: Dict[str, Any], pretty: bool = False, fsync: bool = False) -> None:
+    # Compact by default: these files are rewritten on every update and only
+    # read back by code, so indentation just doubles the bytes to write and parse
+    option = ORJSON_OPTIONS | orjson.OPT_INDENT_2 if pretty else ORJSON_OPTIONS
+    _atomic_write(path, orjson.dumps(data, option=option), fsync=fsync)
+
+# One read, one in-place change, one atomic write, all under the session lock
+def _mutate_context(path: str, mutate: Callable[[Dict[str, Any]], None]) -> None:
+    with session_lock(path):
+        data = read_context(path)
+        mutate(data)
+        write_context(path, data)
 
 def update_context_from_llm(path: str, update_text: str, source: str = "user") -> None:
-    context = read_context(path)
-    
-    if "history" not in context:
-        context["history"] = []
-    
-    entry = {
-        "content": update_text,
-        "source": source,
-        "timestamp": int(time.time())
-    }
-    
-    context["history"].append(entry)
-    
-    context["latest_update"] = update_text
-    context["last_updated"] = int(time.time())
-    
-    write_context(path, context)
+    now = int(time.time())
 
-def append_to_chat_history(path: str, message: Dict[str, Any]) -> None:
-    chat_history = read_context(path)
-    
-    if "messages" not in chat_history:
-        chat_history["messages"] = []
-    
-    chat_history["messages"].append(message)
-    
-    if len(chat_history["messages"]) > 100:
-        chat_history["messages"] = chat_history["messages"][-100:]
-    
-    write_context(path, chat_history)
+    def add_entry(context: Dict[str, Any]) -> None:
+        history = context.setdefault("history", [])
+        history.append({
+            "content": update_text,
+            "source": source,
+            "timestamp": now
+        })
+        # context.json is rewritten on every update and embedded in every prompt, so it keeps
+        # only the newest entries; older ones move to an append-only archive beside it
+        if len(history) > CONTEXT_HISTORY_LIMIT:
+            evicted = history[:-CONTEXT_HISTORY_LIMIT]
+            with open(path + CONTEXT_ARCHIVE_SUFFIX, "ab") as f:
+                f.write(b"".join(
+                    orjson.dumps(entry, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE) for entry in evicted
+                ))
+            del history[:-CONTEXT_HISTORY_LIMIT]
+            context["archived_history_entries"] = context.get("archived_history_entries", 0) + len(evicted)
+        context["latest_update"] = update_text
+        context["last_updated"] = now
+
+    _mutate_context(path, add_entry)
+
+def _read_chat_tail(path: str) -> List[Dict[str, Any]]:
+    messages = []
+    try:
+        with open(path, "rb") as f:
+            # deque keeps only the tail, so old lines are never parsed
+            lines = deque(f, maxlen=CHAT_HISTORY_LIMIT)
+    except OSError:
+        return messages
+    for line in lines:
+        try:
+            messages.append(orjson.loads(line))
+        except ValueError:
+            # A torn last line from an interrupted append
+            continue
+    return messages
+
+def _migrate_legacy_chat_history(path: str) -> bool:
+    # Sessions from before the JSONL switch keep {"messages": [...]} in chat_history.json;
+    # convert it the first time the .jsonl file is looked for and found missing
+    legacy_path = os.path.splitext(path)[0] + ".json"
+    with session_lock(path):
+        if os.path.exists(path) or not os.path.exists(legacy_path):
+            return False
+        messages = read_context(legacy_path).get("messages", [])
+        _atomic_write(path, b"".join(
+            orjson.dumps(m, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+            for m in messages
+        ))
+        os.remove(legacy_path)
+    return True
+
+# Returns {"messages": [...]} with at most the last CHAT_HISTORY_LIMIT messages.
+# Like read_context_cached, the result is shared between callers and must not be mutated.
+def read_chat_history(path: str) -> Dict[str, Any]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        if not _migrate_legacy_chat_history(path):
+            return {"messages": []}
+        st = os.stat(path)
+
+    with _read_cache_lock:
+        cached = _read_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    data = {"messages": _read_chat_tail(path)}
+    with _read_cache_lock:
+        _read_cache[path] = (st.st_mtime_ns, st.st_size, data)
+    return data
+
+def append_to_chat_history(path: str, *messages: Dict[str, Any]) -> None:
+    # One line appended per message instead of re-serializing the whole history; a
+    # turn's messages go out in a single write so readers never see half a turn
+    lines = b"".join(
+        orjson.dumps(m, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+        for m in messages
+    )
+    with session_lock(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            _migrate_legacy_chat_history(path)
+        with open(path, "ab") as f:
+            f.write(lines)
+            size = f.tell()
+
+        if size > CHAT_HISTORY_COMPACT_BYTES:
+            tail = b"".join(
+                orjson.dumps(m, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+                for m in _read_chat_tail(path)
+            )
+            _atomic_write(path, tail)
 
 def append_dataset_metadata(path: str, metadata: Dict[str, Any]) -> None:
-    all_metadata = read_context(path)
-    
-    if "datasets" not in all_metadata:
-        all_metadata["datasets"] = []
-    
-    all_metadata["datasets"].append(metadata)
-    all_metadata["last_updated"] = int(time.time())
-    
-    write_context(path, all_metadata)
+    def upsert(all_metadata: Dict[str, Any]) -> None:
+        # Re-uploading a file overwrites it on disk, so replace its entry rather than
+        # accumulating stale duplicates that every later prompt would carry
+        datasets = all_metadata.setdefault("datasets", [])
+        filename = metadata.get("filename")
+        index = next((i for i, d in enumerate(datasets) if d.get("filename") == filename), None)
+        if index is None:
+            datasets.append(metadata)
+        else:
+            datasets[index] = metadata
+        all_metadata["last_updated"] = int(time.time())
+
+    _mutate_context(path, upsert)
 
 def get_context_summary(path: str, max_entries: int = 5) -> str:
-    context = read_context(path)
+    context = read_context_cached(path)
     history = context.get("history", [])
     
     if not history:
@@ -89,4 +258,4 @@ def search_context(path: str, query: str, max_results: int = 5) -> List[Dict[str
         if query_lower in content:
             results.append(entry)
     
-    return results[-max_results:]
\ No newline at end of file
+    return results[-max_results:]
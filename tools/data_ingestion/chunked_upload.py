@@ -0,0 +1,164 @@
+import os
+import shutil
+import time
+import uuid
+from typing import Any, BinaryIO, Dict, List, Tuple
+
+from tools.context_management.context_handler import read_context_cached, write_context
+from tools.data_ingestion.parser import UPLOAD_CHUNK_SIZE
+
+CHUNK_SIZE = 5 * 1024 * 1024
+MANIFEST_NAME = "manifest.json"
+# Upload directories untouched for this long belong to abandoned uploads
+STALE_UPLOAD_SECONDS = 24 * 60 * 60
+
+
+def _upload_dir(uploads_dir: str, upload_id: str) -> str:
+    # Round-trip through UUID so a client-supplied id can never escape uploads_dir
+    return os.path.join(uploads_dir, uuid.UUID(upload_id).hex)
+
+
+def _part_path(upload_dir: str, index: int) -> str:
+    return os.path.join(upload_dir, f"part{index:05d}")
+
+
+def _expected_chunk_size(manifest: Dict[str, Any], index: int) -> int:
+    # Every chunk is chunk_size bytes except the last, which holds the remainder
+    if index < manifest["total_chunks"] - 1:
+        return manifest["chunk_size"]
+    return manifest["total_size"] - manifest["chunk_size"] * (manifest["total_chunks"] - 1)
+
+
+def _prune_stale_uploads(uploads_dir: str) -> None:
+    # Each saved chunk renames a file into its upload directory, bumping the directory's
+    # mtime, so an old mtime means nobody has sent a chunk for that long
+    cutoff = time.time() - STALE_UPLOAD_SECONDS
+    try:
+        with os.scandir(uploads_dir) as entries:
+            stale = [entry.path for entry in entries if entry.is_dir() and entry.stat().st_mtime < cutoff]
+    except FileNotFoundError:
+        return
+    for path in stale:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def init_upload(uploads_dir: str, filename: str, total_size: int) -> Dict[str, Any]:
+    _prune_stale_uploads(uploads_dir)
+    upload_id = uuid.uuid4().hex
+    total_chunks = max(1, -(-total_size // CHUNK_SIZE))
+
+    manifest = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "total_size": total_size,
+        "chunk_size": CHUNK_SIZE,
+        "total_chunks": total_chunks,
+    }
+    write_context(os.path.join(_upload_dir(uploads_dir, upload_id), MANIFEST_NAME), manifest)
+    return manifest
+
+
+def read_manifest(uploads_dir: str, upload_id: str) -> Dict[str, Any]:
+    # Read on every chunk but never rewritten after init_upload, so the parse is reused
+    return read_context_cached(os.path.join(_upload_dir(uploads_dir, upload_id), MANIFEST_NAME))
+
+
+def received_chunks(uploads_dir: str, upload_id: str) -> List[int]:
+    # scandir answers is_file() from the directory entry itself, with no stat per part
+    try:
+        with os.scandir(_upload_dir(uploads_dir, upload_id)) as entries:
+            return sorted(
+                int(entry.name[4:]) for entry in entries
+                if entry.name.startswith("part") and entry.name[4:].isdigit() and entry.is_file()
+            )
+    except (FileNotFoundError, NotADirectoryError):
+        raise ValueError("Unknown upload_id")
+
+
+def save_chunk(uploads_dir: str, upload_id: str, index: int, stream: BinaryIO) -> None:
+    manifest = read_manifest(uploads_dir, upload_id)
+    if not manifest:
+        raise ValueError("Unknown upload_id")
+    if not 0 <= index < manifest["total_chunks"]:
+        raise ValueError(f"Chunk index out of range (0-{manifest['total_chunks'] - 1})")
+
+    expected = _expected_chunk_size(manifest, index)
+    part_path = _part_path(_upload_dir(uploads_dir, upload_id), index)
+    tmp_path = part_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            # Reads at most one byte past the expected size: enough to reject an oversized
+            # chunk without letting a client stream unbounded data past MAX_CONTENT_LENGTH
+            remaining = expected + 1
+            while remaining > 0:
+                block = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+            received = f.tell()
+        if received != expected:
+            raise ValueError(f"Chunk {index} must be {expected} bytes")
+
+        # Only whole chunks become visible, so a dropped connection is simply resent
+        os.replace(tmp_path, part_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def complete_upload(uploads_dir: str, upload_id: str, save_dir: str) -> Tuple[str, int]:
+    manifest = read_manifest(uploads_dir, upload_id)
+    if not manifest:
+        raise ValueError("Unknown upload_id")
+
+    missing = sorted(set(range(manifest["total_chunks"])) - set(received_chunks(uploads_dir, upload_id)))
+    if missing:
+        raise ValueError(f"Missing chunks: {missing}")
+
+    upload_dir = _upload_dir(uploads_dir, upload_id)
+    os.makedirs(save_dir, exist_ok=True)
+    file_path = os.path.join(save_dir, manifest["filename"])
+
+    # Assembled beside the target and renamed, so a failed assembly never clobbers an
+    # existing dataset of the same name
+    tmp_path = f"{file_path}.{upload_id}.part"
+    try:
+        with open(tmp_path, "wb") as out:
+            for index in range(manifest["total_chunks"]):
+                with open(_part_path(upload_dir, index), "rb") as part:
+                    _copy_file(part, out)
+            size_bytes = out.tell()
+        if size_bytes != manifest["total_size"]:
+            raise ValueError(f"Assembled {size_bytes} bytes, expected {manifest['total_size']}")
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    shutil.rmtree(upload_dir, ignore_errors=True)
+    return file_path, size_bytes
+
+
+def _copy_file(src: BinaryIO, dst: BinaryIO) -> None:
+    # sendfile keeps the bytes in the kernel where it supports file-to-file copies
+    if hasattr(os, "sendfile"):
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError:
+            if offset:
+                raise
+    shutil.copyfileobj(src, dst, length=UPLOAD_CHUNK_SIZE)
@@ -1,20 +1,65 @@
+import importlib
 import os
 import pandas as pd
-import json
 import time
+import shutil
 import sqlite3
-from typing import Dict, Any
-from dotenv import load_dotenv
-import google.generativeai as genai
+import uuid
+from contextlib import closing
+from datetime import date, time as dt_time
+import orjson
+from typing import Dict, Any, BinaryIO, Callable, List, Optional, Tuple
+from urllib.parse import quote
 
-from tools.context_management.context_handler import append_dataset_metadata, update_context_from_llm
+from tools.context_management.context_handler import _UMASK, append_dataset_metadata, update_context_from_llm
+from tools.llm.models import JSON_GENERATION_CONFIG, get_model, strip_code_fence
+from tools.llm.response_cache import cache_key, cached_generate
+from tools.task_queue.jobs import run_blocking
 
-load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _engine_if_installed(module: str, engine: str) -> Optional[str]:
+    # None lets pandas fall back to its default engine
+    try:
+        importlib.import_module(module)
+    except ImportError:
+        return None
+    return engine
+
+
+# python-calamine (Rust) reads workbooks several times faster than openpyxl/xlrd
+EXCEL_ENGINE = _engine_if_installed("python_calamine", "calamine")
+# pyarrow parses CSV on every core instead of pandas' single-threaded C parser
+CSV_ENGINE = _engine_if_installed("pyarrow", "pyarrow")
+# Enough rows for pandas to settle on column dtypes without parsing the whole upload
+CSV_SAMPLE_ROWS = 10_000
+
+
+def _quote_identifier(name: str) -> str:
+    # Table names come from the uploaded file itself, so never splice them in raw
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _json_safe_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    # NaN/NaT become None and timestamps, dates and times become ISO strings, so samples
+    # stay valid JSON on disk and over the wire. Datetime columns convert column-wise;
+    # only object columns that actually hold date/time values (Excel cells, mostly) get
+    # isoformat, and only on those cells. Everything else passes through untouched
+    out = df.copy()
+    for col in out.select_dtypes(include=["datetime"]).columns:
+        out[col] = out[col].dt.strftime("%Y-%m-%dT%H:%M:%S")
+    for col in out.select_dtypes(include=["datetimetz"]).columns:
+        out[col] = out[col].dt.strftime("%Y-%m-%dT%H:%M:%S%z")
+    for col in out.select_dtypes(include=["object"]).columns:
+        temporal = out[col].map(lambda v: isinstance(v, (date, dt_time)))
+        if temporal.any():
+            out.loc[temporal, col] = out.loc[temporal, col].map(lambda v: v.isoformat())
+    return out.astype(object).where(out.notna(), None).to_dict(orient="records")
 
 
 def extract_metadata_with_llm(filename: str, basic_metadata: Dict[str, Any]) -> Dict[str, Any]:
-    model = genai.GenerativeModel("gemini-1.5-flash")
+    model = get_model("gemini-1.5-flash")
 
     prompt = f"""Analyze this dataset metadata and provide rich context:
 
@@ -33,16 +78,20 @@ Respond with ONLY a JSON object containing:
 
 Only valid JSON, no additional text."""
 
-    try:
-        response = model.generate_content(prompt)
+    def generate() -> str:
+        response = model.generate_content(prompt, generation_config=JSON_GENERATION_CONFIG)
         response_text = getattr(response, "text", "{}").strip()
 
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
+        response_text = strip_code_fence(response_text)
+
+        # Raise before caching so a malformed reply is retried on the next upload
+        orjson.loads(response_text)
+        return response_text
 
-        return json.loads(response_text)
+    try:
+        # The prompt is just name, type, columns and row count, so re-uploading the same
+        # (or a structurally identical) dataset reuses the earlier insights
+        return orjson.loads(cached_generate(cache_key("gemini-1.5-flash", prompt), generate))
     except Exception as e:
         return {
             "description": "Metadata extraction failed",
@@ -50,109 +99,263 @@ Only valid JSON, no additional text."""
         }
 
 
-def handle_file_upload(file, save_dir: str, metadata_path: str, context_path: str) -> Dict[str, Any]:
+def save_upload_stream(stream: BinaryIO, filename: str, save_dir: str) -> Tuple[str, int]:
     os.makedirs(save_dir, exist_ok=True)
 
-    filename = file.filename
     file_path = os.path.join(save_dir, filename)
-    file.save(file_path)
 
-    metadata = {
-        "filename": filename,
-        "file_path": file_path,
-        "upload_timestamp": int(time.time()),
-        "columns": [],
-        "rows": 0,
-        "type": None,
-        "size_bytes": os.path.getsize(file_path)
+    spool_path = getattr(stream, "name", None)
+    if isinstance(spool_path, str):
+        # Multipart parts are already spooled to disk on this filesystem; link, don't copy
+        stream.flush()
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+        try:
+            os.link(spool_path, tmp_path)
+        except OSError:
+            stream.seek(0)
+        else:
+            try:
+                # The spool file is 0600; give the dataset the umask-based mode a plain
+                # open() would, so the X-Accel-Redirect download path can read it
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+                os.replace(tmp_path, file_path)
+                return file_path, os.fstat(stream.fileno()).st_size
+            except OSError:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                stream.seek(0)
+
+    # Streamed into a temp file and renamed, so an aborted or oversized upload never
+    # truncates an existing dataset of the same name or leaves partial bytes behind
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(stream, f, length=UPLOAD_CHUNK_SIZE)
+            # Bytes written so far; saves process_dataset a stat() of the new file
+            size_bytes = f.tell()
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return file_path, size_bytes
+
+
+def _count_csv_rows(file_path: str) -> int:
+    if CSV_ENGINE == "pyarrow":
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+
+        # Streams record batches and keeps only the first column, left unconverted as strings
+        reader = pa_csv.open_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(skip_rows=1, autogenerate_column_names=True),
+            convert_options=pa_csv.ConvertOptions(include_columns=["f0"], column_types={"f0": pa.string()})
+        )
+        return sum(batch.num_rows for batch in reader)
+
+    with pd.read_csv(file_path, usecols=[0], dtype=str, chunksize=CSV_SAMPLE_ROWS * 10) as reader:
+        return sum(len(chunk) for chunk in reader)
+
+
+def _write_parquet_copy(file_path: str) -> Optional[Tuple[str, int]]:
+    # Typed columnar copy next to the upload so every CoTAS step script can
+    # pd.read_parquet() it instead of re-tokenizing the CSV and re-parsing dates
+    parquet_path = f"{file_path}.parquet"
+    if CSV_ENGINE != "pyarrow":
+        return None
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyarrow import csv as pa_csv
+
+    tmp_path = f"{parquet_path}.{uuid.uuid4().hex}.part"
+    rows = 0
+    try:
+        with pa_csv.open_csv(file_path) as reader:
+            # Store date columns as timestamps so read_parquet() hands scripts datetime64
+            # straight away, with no pd.to_datetime pass over the column afterwards
+            schema = pa.schema([
+                field.with_type(pa.timestamp("ms")) if pa.types.is_date(field.type) else field
+                for field in reader.schema
+            ])
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch.cast(schema))
+                    rows += batch.num_rows
+        os.replace(tmp_path, parquet_path)
+    except (pa.ArrowException, OSError):
+        # Column types can drift past the first block; scripts then fall back to the CSV
+        for stale in (tmp_path, parquet_path):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        return None
+
+    return parquet_path, rows
+
+
+def _parse_csv(file_path: str) -> Dict[str, Any]:
+    # Columns, dtypes and the sample only need the head; a full DataFrame is never built
+    df = pd.read_csv(file_path, nrows=CSV_SAMPLE_ROWS)
+
+    parsed = {
+        "type": "csv",
+        "columns": df.columns.tolist(),
+        "rows": len(df),
+        "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
+        "sample_data": _json_safe_records(df.head(3))
     }
 
-    try:
-        if filename.endswith(".csv"):
-            df = pd.read_csv(file_path)
-            metadata.update({
-                "type": "csv",
+    # The Parquet pass already streams every row, so it doubles as the row count
+    parquet = _write_parquet_copy(file_path)
+    if parquet is not None:
+        parsed["parquet_path"], parsed["rows"] = parquet
+    elif len(df) >= CSV_SAMPLE_ROWS:
+        parsed["rows"] = _count_csv_rows(file_path)
+
+    return parsed
+
+
+def _parse_excel(file_path: str) -> Dict[str, Any]:
+    sheets_metadata = []
+
+    # One open workbook for every sheet; read_excel per sheet would reopen and
+    # re-index the whole archive each time
+    with pd.ExcelFile(file_path, engine=EXCEL_ENGINE) as excel_file:
+        for sheet_name in excel_file.sheet_names:
+            df = excel_file.parse(sheet_name)
+            sheets_metadata.append({
+                "sheet_name": sheet_name,
                 "columns": df.columns.tolist(),
                 "rows": len(df),
-                "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
-                "sample_data": df.head(3).to_dict(orient="records")
+                "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()}
             })
 
-        elif filename.endswith((".xlsx", ".xls")):
-            excel_file = pd.ExcelFile(file_path)
-            sheets_metadata = []
-
-            for sheet_name in excel_file.sheet_names:
-                df = pd.read_excel(file_path, sheet_name=sheet_name)
-                sheets_metadata.append({
-                    "sheet_name": sheet_name,
-                    "columns": df.columns.tolist(),
-                    "rows": len(df),
-                    "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()}
-                })
-
-            metadata.update({
-                "type": "excel",
-                "sheets": sheets_metadata,
-                "num_sheets": len(excel_file.sheet_names)
-            })
+    parsed = {
+        "type": "excel",
+        "sheets": sheets_metadata,
+        "num_sheets": len(sheets_metadata)
+    }
 
-            if sheets_metadata:
-                metadata["columns"] = sheets_metadata[0]["columns"]
-                metadata["rows"] = sheets_metadata[0]["rows"]
+    if sheets_metadata:
+        parsed["columns"] = sheets_metadata[0]["columns"]
+        parsed["rows"] = sheets_metadata[0]["rows"]
+
+    return parsed
+
+
+def _parse_sqlite(file_path: str) -> Dict[str, Any]:
+    # Read-only and immutable: the upload is our own copy that nothing else writes,
+    # so SQLite can skip file locking and change detection entirely.
+    # closing() releases the file even when a query fails part-way through
+    uri = f"file:{quote(os.path.abspath(file_path))}?mode=ro&immutable=1"
+    with closing(sqlite3.connect(uri, uri=True)) as conn:
+        conn.execute("PRAGMA temp_store = MEMORY")
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+        # If the file was ANALYZEd, sqlite_stat1 already holds each table's row count
+        # (the leading integer of stat); reading it avoids a full scan per table
+        estimated_rows = {}
+        if "sqlite_stat1" in tables:
+            estimated_rows = dict(conn.execute(
+                "SELECT tbl, MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 GROUP BY tbl"
+            ))
+
+        tables_metadata = []
+        for table in tables:
+            quoted = _quote_identifier(table)
+            # table_info reads the schema alone instead of preparing a SELECT * per table
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quoted})")]
+
+            table_metadata = {
+                "table_name": table,
+                "columns": columns
+            }
+            if estimated_rows.get(table) is not None:
+                table_metadata["rows"] = estimated_rows[table]
+                table_metadata["rows_estimated"] = True
+            else:
+                table_metadata["rows"] = conn.execute(f"SELECT COUNT(*) FROM {quoted}").fetchone()[0]
+
+            tables_metadata.append(table_metadata)
+
+    parsed = {
+        "type": "database",
+        "tables": tables_metadata,
+        "num_tables": len(tables)
+    }
 
-        elif filename.endswith((".db", ".sqlite")):
-            conn = sqlite3.connect(file_path)
-            cursor = conn.cursor()
+    if tables_metadata:
+        parsed["columns"] = tables_metadata[0]["columns"]
+        parsed["rows"] = tables_metadata[0]["rows"]
 
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            tables = [row[0] for row in cursor.fetchall()]
+    return parsed
 
-            tables_metadata = []
-            for table in tables:
-                cursor.execute(f"SELECT * FROM {table} LIMIT 0")
-                columns = [desc[0] for desc in cursor.description]
-                cursor.execute(f"SELECT COUNT(*) FROM {table}")
-                row_count = cursor.fetchone()[0]
 
-                tables_metadata.append({
-                    "table_name": table,
-                    "columns": columns,
-                    "rows": row_count
-                })
+def _parse_json(file_path: str) -> Dict[str, Any]:
+    # orjson parses straight from the raw bytes, skipping the str decode
+    with open(file_path, "rb") as f:
+        data = orjson.loads(f.read())
 
-            conn.close()
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        return {
+            "type": "json",
+            "columns": list(data[0].keys()),
+            "rows": len(data),
+            "sample_data": data[:3]
+        }
 
-            metadata.update({
-                "type": "database",
-                "tables": tables_metadata,
-                "num_tables": len(tables)
-            })
+    return {
+        "type": "json",
+        "structure": type(data).__name__,
+        "rows": 1
+    }
 
-            if tables_metadata:
-                metadata["columns"] = tables_metadata[0]["columns"]
-                metadata["rows"] = tables_metadata[0]["rows"]
-
-        elif filename.endswith(".json"):
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list) and data and isinstance(data[0], dict):
-                    metadata.update({
-                        "type": "json",
-                        "columns": list(data[0].keys()),
-                        "rows": len(data),
-                        "sample_data": data[:3]
-                    })
-                else:
-                    metadata.update({
-                        "type": "json",
-                        "structure": type(data).__name__,
-                        "rows": 1
-                    })
 
-        else:
+# One lookup per upload instead of an endswith() chain; adding a format means adding a row here
+PARSERS: Dict[str, Callable[[str], Dict[str, Any]]] = {
+    ".csv": _parse_csv,
+    ".xlsx": _parse_excel,
+    ".xls": _parse_excel,
+    ".db": _parse_sqlite,
+    ".sqlite": _parse_sqlite,
+    ".json": _parse_json,
+}
+
+
+def allowed_file(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in PARSERS
+
+
+def process_dataset(file_path: str, metadata_path: str, context_path: str, size_bytes: Optional[int] = None) -> Dict[str, Any]:
+    filename = os.path.basename(file_path)
+
+    metadata = {
+        "filename": filename,
+        "file_path": file_path,
+        "upload_timestamp": int(time.time()),
+        "columns": [],
+        "rows": 0,
+        "type": None,
+        "size_bytes": size_bytes if size_bytes is not None else os.path.getsize(file_path)
+    }
+
+    parse = PARSERS.get(os.path.splitext(filename)[1].lower())
+
+    try:
+        if parse is None:
             metadata["type"] = "unknown"
             metadata["error"] = "Unsupported file type"
+        else:
+            # Only the parse leaves the job's greenlet; the Gemini call below must not
+            metadata.update(run_blocking(parse, file_path))
 
     except Exception as e:
         metadata["type"] = "error"
@@ -0,0 +1,42 @@
+import os
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+# Every variable the README documents for .env; the file is only searched for when one of
+# them is missing from the environment, and never overrides a value that is already set
+DOTENV_VARIABLES = ("GOOGLE_API_KEY", "X_ACCEL_REDIRECT_PREFIX", "SCRIPT_MEMORY_LIMIT_MB")
+if not all(os.getenv(name) for name in DOTENV_VARIABLES):
+    load_dotenv()
+
+# Shared by every call that parses the reply as JSON; built once rather than per request
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+# A ```json fence wins over a bare one; an unterminated fence runs to the end of the reply
+_JSON_FENCE = re.compile(r"```json(.*?)(?:```|\Z)", re.DOTALL)
+_ANY_FENCE = re.compile(r"```(.*?)(?:```|\Z)", re.DOTALL)
+
+
+@lru_cache(maxsize=1)
+def _genai():
+    # Imported on first use: the SDK drags in gRPC and protobuf, which dominates cold start
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai
+
+
+# One model object per (name, system instruction), shared by every request and
+# background job; generate_content keeps no per-call state on the instance
+@lru_cache(maxsize=None)
+def get_model(name: str, system_instruction: Optional[str] = None) -> "genai.GenerativeModel":
+    return _genai().GenerativeModel(name, system_instruction=system_instruction)
+
+
+def strip_code_fence(text: str) -> str:
+    # JSON mode rarely fences its reply, but older models and fallbacks still do
+    match = _JSON_FENCE.search(text) or _ANY_FENCE.search(text)
+    return match.group(1).strip() if match else text
@@ -1,65 +1,190 @@
-import json
 import os
+import re
+import threading
 import time
-from typing import Dict, Any, Generator
-from dotenv import load_dotenv
-import google.generativeai as genai
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Any, Generator, Optional, Tuple
+
+import orjson
 
 from tools.context_management.context_handler import (
-    read_context, write_context, append_to_chat_history, 
+    read_chat_history, read_context_cached, write_context, append_to_chat_history, 
     update_context_from_llm
 )
-from tools.script_executor.sandbox import run_script_safely
-
-load_dotenv()
-api_key = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=api_key)
-
-def process_user_message(message: str, paths: dict) -> dict:
-    context = read_context(paths["context"])
-    dataset_metadata = read_context(paths["dataset_metadata"])
-    chat_history = read_context(paths["chat_history"])
-    
-    prompt = f"""You are a data analysis copilot orchestrator. Analyze the user's message and determine what information should be stored.
-
-CURRENT CONTEXT:
-{json.dumps(context, indent=2)}
+from tools.llm.models import JSON_GENERATION_CONFIG, get_model, strip_code_fence
+from tools.llm.response_cache import cache_key, cached_generate
+from tools.script_executor.sandbox import directory_fingerprint, run_script_cached, run_script_safely
+from tools.serialization.json_provider import ORJSON_OPTIONS
 
-DATASET METADATA:
-{json.dumps(dataset_metadata, indent=2)}
+def _dumps(obj: Any) -> str:
+    # Compact: indentation and spaces after separators cost tokens on every call without
+    # telling the model anything. orjson also keeps non-ASCII text as-is instead of \u escapes
+    return orjson.dumps(obj, option=ORJSON_OPTIONS).decode()
 
-RECENT CHAT HISTORY:
-{json.dumps(chat_history.get('messages', [])[-5:], indent=2)}
+# Static instructions go in the system instruction so they form a fixed
+# prefix that Gemini's implicit prompt caching can reuse across turns
+CHAT_SYSTEM_PROMPT = """You are a data analysis copilot orchestrator. Analyze the user's message and determine what information should be stored.
 
-USER MESSAGE:
-{message}
+Once datasets or context exist, the first message holds the dataset metadata and the current context. The recent conversation follows, ending with the user's latest message.
 
-TASK: Analyze this message and respond with a JSON object containing:
+TASK: Analyze the user's message and respond with a JSON object containing:
 1. "response" - Your conversational response to the user
 2. "context_update" - Any important information to add to context (company info, goals, constraints, etc.) or null if nothing to add
 3. "needs_analysis" - Boolean indicating if this requires data analysis
 
 Example output:
-{{
+{
   "response": "I understand you want to analyze sales trends. I'll help you with that.",
   "context_update": "User wants to analyze quarterly sales trends with focus on regional performance",
   "needs_analysis": true
-}}
+}
 
 Respond with ONLY valid JSON, no additional text."""
 
-    model = genai.GenerativeModel("gemini-2.5-flash")
+# Fixed CoTAS instructions, sent as the system instruction so every step's request
+# starts with the same prefix for Gemini's implicit prompt caching
+COTAS_SYSTEM_PROMPT = """You are an autonomous data analysis agent using CoTAS methodology (Thought-Action-Search).
+
+Each request gives the analysis goal, the available datasets, the current context, the previous output and the number of completed steps.
+
+YOUR TASK:
+Each turn, decide the next action to move towards the goal. Choose ONE:
+
+1. THINK - Reasoning about what to do next, planning, or analyzing results
+   Use when: You need to plan, reason about findings, or synthesize information
+
+2. ACT - Execute Python code to analyze data, create visualizations, or compute results
+   Use when: You need to process data, generate insights, or create outputs
+   IMPORTANT: Code must be complete and runnable. Include all imports.
+   pandas, numpy, pyarrow and matplotlib are installed; never install packages (no pip/subprocess calls).
+   Available data paths: storage/<session_id>/datasets/<filename>
+   If a dataset lists a parquet_path, load it with pd.read_parquet() instead of re-reading the CSV.
+   When reading a CSV, use pd.read_csv(..., engine="pyarrow") for multithreaded parsing, and parse date columns
+   in the read itself (parse_dates=[...]), not with a later pd.to_datetime.
+   Load only the columns the step needs (usecols=[...] for CSV, columns=[...] for Parquet).
+   There is no display: save charts with fig.savefig("storage/<session_id>/results/<name>.png") and plt.close(fig), never plt.show().
+
+3. DONE - Analysis complete, ready to provide final insights
+   Use when: Goal is achieved and you have comprehensive findings
+
+Respond with ONLY valid JSON in this EXACT format:
+
+{
+  "action": "THINK",
+  "content": "Your reasoning here",
+  "context_update": "Important insight to remember" or null
+}
+
+OR
+
+{
+  "action": "ACT",
+  "content": "import pandas as pd\\nimport matplotlib.pyplot as plt\\n# Complete Python code",
+  "context_update": "What this analysis aims to discover" or null
+}
+
+OR
+
+{
+  "action": "DONE",
+  "content": "Final comprehensive insights and findings",
+  "context_update": null
+}
+
+When PREVIOUS OUTPUT is a code execution result, add an "insight" field to whichever action you choose:
+a brief insight about what the code accomplished, its key findings (if any) and what should happen next.
+
+No additional text. Only valid JSON."""
+
+# Chat history roles as Gemini expects them; error entries are not replayed
+CHAT_ROLES = {"user": "user", "assistant": "model"}
+
+def _chat_contents(preamble: Optional[str], messages: list, message: str) -> list:
+    # Past turns go in as native Gemini turns instead of a JSON dump inside one prompt
+    contents = [{"role": "user", "parts": [preamble]}] if preamble else []
+    turns = [(CHAT_ROLES.get(m.get("role")), m.get("message")) for m in messages]
+    turns = [(role, text) for role, text in turns if role is not None and text]
+    # A tail sliced from alternating history can start on a reply whose question was cut
+    # off; drop it so the conversation opens with a user turn, as Gemini expects
+    while turns and turns[0][0] == "model":
+        turns.pop(0)
+    for role, text in turns + [("user", message)]:
+        if not text:
+            continue
+        # Consecutive turns from the same side are merged so roles keep alternating
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].append(text)
+        else:
+            contents.append({"role": role, "parts": [text]})
+    return contents
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+# Context history grows for the life of a session; prompts only carry the newest entries
+PROMPT_CONTEXT_HISTORY = 10
+
+def _context_json(context: Dict[str, Any]) -> str:
+    history = context.get("history", [])
+    if len(history) <= PROMPT_CONTEXT_HISTORY:
+        return _dumps(context)
+    trimmed = {
+        **context,
+        "history": history[-PROMPT_CONTEXT_HISTORY:],
+        "earlier_history_entries": len(history) - PROMPT_CONTEXT_HISTORY
+    }
+    return _dumps(trimmed)
+
+# Keyed on the files' signatures, so an unchanged session reuses the rendered text
+# instead of re-reading and re-serializing both files on every chat message
+@lru_cache(maxsize=256)
+def _chat_preamble(metadata_path: str, context_path: str, metadata_sig, context_sig) -> Optional[str]:
+    dataset_metadata = read_context_cached(metadata_path)
+    context = read_context_cached(context_path)
+    
+    # A fresh session has nothing to ground on yet; send the bare conversation
+    if not (dataset_metadata.get("datasets") or context.get("history")):
+        return None
+    
+    # Most stable section first so consecutive turns share the longest prefix
+    return f"""DATASET METADATA:
+{_dumps(dataset_metadata)}
+
+CURRENT CONTEXT:
+{_context_json(context)}"""
+
+def process_user_message(message: str, paths: dict) -> dict:
+    chat_history = read_chat_history(paths["chat_history"])
+    
+    preamble = _chat_preamble(
+        paths["dataset_metadata"], paths["context"],
+        _file_signature(paths["dataset_metadata"]), _file_signature(paths["context"])
+    )
+    contents = _chat_contents(preamble, chat_history.get('messages', [])[-5:], message)
+
+    model = get_model("gemini-2.5-flash", CHAT_SYSTEM_PROMPT)
+    
+    def generate() -> str:
+        response = model.generate_content(contents, generation_config=JSON_GENERATION_CONFIG)
+        text = strip_code_fence(getattr(response, "text", str(response)).strip())
+        # Check before returning so a malformed reply raises instead of being cached and replayed
+        if not isinstance(orjson.loads(text), dict):
+            raise ValueError("Chat reply is not a JSON object")
+        return text
     
     try:
-        response = model.generate_content(prompt)
-        response_text = getattr(response, "text", str(response)).strip()
+        # An identical prompt (same metadata, context, history and message) gets the same reply
+        response_text = cached_generate(
+            cache_key("gemini-2.5-flash", CHAT_SYSTEM_PROMPT, orjson.dumps(contents).decode()),
+            generate
+        )
         
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        result = json.loads(response_text)
+        result = orjson.loads(response_text)
         
         if result.get("context_update"):
             update_context_from_llm(
@@ -68,17 +193,16 @@ Respond with ONLY valid JSON, no additional text."""
                 source="user_chat" 
             )
         
+        now = int(time.time())
         append_to_chat_history(paths["chat_history"], {
             "role": "user",
             "message": message,
-            "timestamp": int(time.time())
-        })
-        
-        append_to_chat_history(paths["chat_history"], {
+            "timestamp": now
+        }, {
             "role": "assistant",
             "message": result.get("response", ""),
             "context_update": result.get("context_update"),
-            "timestamp": int(time.time())
+            "timestamp": now
         })
         
         return {
@@ -101,92 +225,96 @@ Respond with ONLY valid JSON, no additional text."""
             "needs_analysis": False
         }
 
-def cotas_generate_insights(paths: dict, user_goal: str, max_loops: int = 15) -> Generator[str, None, None]:
-    context = read_context(paths["context"])
-    dataset_metadata = read_context(paths["dataset_metadata"])
-    model = genai.GenerativeModel("gemini-2.5-flash")
+# How much of a script's stdout/stderr the next decision gets to read
+COTAS_OUTPUT_CHARS = 8000
+
+# A THINK whose words overlap this much with one of the last few is treated as the
+# agent going round in circles, and the next decision is told to move on
+REPEAT_SIMILARITY = 0.9
+REPEAT_WINDOW = 3
+REPEAT_NOTE = "\n\nNOTE: This repeats an earlier THINK step. Do not THINK again; take an ACT or DONE action."
+_WORD = re.compile(r"\w+")
+
+def _word_set(text: str) -> frozenset:
+    return frozenset(_WORD.findall(text.lower()))
+
+def _is_repeat(words: frozenset, recent) -> bool:
+    # Jaccard similarity on word sets: cheap, local, and enough to catch near-verbatim loops
+    return any(len(words & seen) >= REPEAT_SIMILARITY * len(words | seen) for seen in recent if words | seen)
+
+def _add_token_usage(totals: Dict[str, int], response: Any) -> None:
+    # cached_content_token_count is how much of the prompt Gemini's implicit prefix
+    # cache served; it stays 0 if the shared prefix stops being byte-identical
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    totals["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+    totals["cached_tokens"] += getattr(usage, "cached_content_token_count", 0) or 0
+
+
+def cotas_generate_insights(paths: dict, user_goal: str, max_loops: int = 15, cancel: Optional[threading.Event] = None) -> Generator[Dict[str, Any], None, None]:
+    # Only read for the prompts, so the cached (shared, read-only) parses are enough
+    context = read_context_cached(paths["context"])
+    dataset_metadata = read_context_cached(paths["dataset_metadata"])
+    # Dataset metadata doesn't change during a run and the context only on a
+    # context_update, so each is serialized when it changes rather than every step
+    datasets_json = _dumps(dataset_metadata)
+    context_json = _context_json(context)
+    model = get_model("gemini-2.5-flash", COTAS_SYSTEM_PROMPT)
     
     cotas_log = {"goal": user_goal, "steps": [], "start_time": int(time.time())}
+    token_usage = {"prompt_tokens": 0, "cached_tokens": 0}
+    cotas_log["token_usage"] = token_usage
+    # start_time/end_time are wall-clock stamps; the duration uses a monotonic clock
+    started = time.perf_counter()
     
     last_output = f"User Goal: {user_goal}"
     step = 0
+    # An ACT step's insight comes back with the next decision instead of from a call of
+    # its own, so its act_complete event waits here until that decision arrives
+    pending_act = None
+    recent_thinks = deque(maxlen=REPEAT_WINDOW)
     
-    yield json.dumps({"type": "start", "message": "Starting CoTAS analysis...", "goal": user_goal})
+    yield {"type": "start", "message": "Starting CoTAS analysis...", "goal": user_goal}
     
     while step < max_loops:
+        # Set when the SSE client goes away; stop before spending another LLM call
+        if cancel is not None and cancel.is_set():
+            break
         step += 1
         
-        decision_prompt = f"""You are an autonomous data analysis agent using CoTAS methodology (Thought-Action-Search).s
-
-ANALYSIS GOAL:
+        # Stable per-run sections first so consecutive steps share the longest prefix
+        decision_prompt = f"""ANALYSIS GOAL:
 {user_goal}
 
-CURRENT CONTEXT:
-{json.dumps(context, indent=2)}
-
 AVAILABLE DATASETS:
-{json.dumps(dataset_metadata, indent=2)}
+{datasets_json}
+
+CURRENT CONTEXT:
+{context_json}
 
 PREVIOUS OUTPUT:
 {last_output}
 
-COMPLETED STEPS: {step - 1}/{max_loops}
-
-YOUR TASK:
-Decide the next action to move towards the goal. Choose ONE:
-
-1. THINK - Reasoning about what to do next, planning, or analyzing results
-   Use when: You need to plan, reason about findings, or synthesize information
-
-2. ACT - Execute Python code to analyze data, create visualizations, or compute results
-   Use when: You need to process data, generate insights, or create outputs
-   IMPORTANT: Code must be complete and runnable. Include all imports.
-   Available data paths: storage/<session_id>/datasets/<filename>
-
-3. DONE - Analysis complete, ready to provide final insights
-   Use when: Goal is achieved and you have comprehensive findings
-
-Respond with ONLY valid JSON in this EXACT format:
-
-{{
-  "action": "THINK",
-  "content": "Your reasoning here",
-  "context_update": "Important insight to remember" or null
-}}
-
-OR
-
-{{
-  "action": "ACT",
-  "content": "import pandas as pd\\nimport matplotlib.pyplot as plt\\n# Complete Python code",
-  "context_update": "What this analysis aims to discover" or null
-}}
-
-OR
-
-{{
-  "action": "DONE",
-  "content": "Final comprehensive insights and findings",
-  "context_update": null
-}}
-
-No additional text. Only valid JSON."""
+COMPLETED STEPS: {step - 1}/{max_loops}"""
 
         try:
-            response = model.generate_content(decision_prompt)
+            response = model.generate_content(decision_prompt, generation_config=JSON_GENERATION_CONFIG)
+            _add_token_usage(token_usage, response)
             response_text = getattr(response, "text", str(response)).strip()
             
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
+            response_text = strip_code_fence(response_text)
             
-            decision = json.loads(response_text)
+            decision = orjson.loads(response_text)
             
             if "action" not in decision or "content" not in decision:
                 raise ValueError("Missing required fields in decision")
                 
         except Exception as e:
+            if pending_act is not None:
+                yield pending_act
+                pending_act = None
+
             error_entry = {
                 "step": step,
                 "action": "ERROR",
@@ -196,20 +324,26 @@ No additional text. Only valid JSON."""
             cotas_log["steps"].append(error_entry)
             write_context(paths["cotas_log"], cotas_log)
             
-            yield json.dumps({
+            yield {
                 "type": "error",
                 "step": step,
                 "message": f"Decision parsing failed: {str(e)}"
-            })
+            }
             break
         
+        if pending_act is not None:
+            pending_act["insight"] = decision.get("insight") or pending_act["insight"]
+            yield pending_act
+            pending_act = None
+        
         action = decision.get("action", "THINK").upper()
         content = decision.get("content", "")
         context_update = decision.get("context_update")
         
         if context_update:
             update_context_from_llm(paths["context"], context_update, f"CoTAS Step {step}")
-            context = read_context(paths["context"])
+            context = read_context_cached(paths["context"])
+            context_json = _context_json(context)
         
         timestamp = int(time.time())
         
@@ -224,19 +358,24 @@ No additional text. Only valid JSON."""
             cotas_log["steps"].append(entry)
             last_output = content
             
-            yield json.dumps({
+            words = _word_set(content)
+            if _is_repeat(words, recent_thinks):
+                last_output += REPEAT_NOTE
+            recent_thinks.append(words)
+            
+            yield {
                 "type": "think",
                 "step": step,
                 "content": content,
                 "context_updated": context_update is not None
-            })
+            }
         
         elif action == "ACT":
-            yield json.dumps({
+            yield {
                 "type": "act_start",
                 "step": step,
                 "message": "Executing code..."
-            })
+            }
             
             script_filename = f"step_{step:03d}_{timestamp}.py"
             script_path = os.path.join(paths["scripts"], script_filename)
@@ -245,21 +384,28 @@ No additional text. Only valid JSON."""
                 with open(script_path, "w", encoding="utf-8") as f:
                     f.write(content)
             except Exception as e:
-                yield json.dumps({
+                yield {
                     "type": "error",
                     "step": step,
                     "message": f"Failed to save script: {str(e)}"
-                })
+                }
                 continue
             
             try:
                 session_id = context.get("session_id", "")
                 modified_code = content.replace(
-                    "storage/<session_id>/datasets/",
-                    f"storage/{session_id}/datasets/"
+                    "storage/<session_id>/",
+                    f"storage/{session_id}/"
                 )
                 
-                exec_result = run_script_safely(modified_code, timeout=30)
+                if "results" in modified_code:
+                    # May read what earlier steps wrote under results/, which changes from
+                    # run to run and isn't covered by the dataset fingerprint; always execute
+                    exec_result = run_script_safely(modified_code, timeout=30)
+                else:
+                    # Same code over the same dataset files (the session path is in the code)
+                    # reprints the same output
+                    exec_result = run_script_cached(modified_code, directory_fingerprint(paths["datasets"]), timeout=30)
                 stdout = exec_result.get("stdout", "")
                 stderr = exec_result.get("stderr", "")
                 
@@ -285,40 +431,26 @@ No additional text. Only valid JSON."""
             }
             cotas_log["steps"].append(entry)
             
-            insight_prompt = f"""Analyze these code execution results:
+            last_output = f"""CODE EXECUTION RESULT (step {step}):
 
 CODE:
 {content}
 
 OUTPUT:
-{stdout if stdout else "(no output)"}
+{stdout[:COTAS_OUTPUT_CHARS] if stdout else "(no output)"}
 
 ERRORS:
-{stderr if stderr else "(no errors)"}
-
-Provide a brief insight about:
-1. What was accomplished
-2. Key findings (if any)
-3. What should happen next
-
-Respond with only the insight text, no formatting."""
-
-            try:
-                insight_resp = model.generate_content(insight_prompt)
-                insight = getattr(insight_resp, "text", stdout or stderr).strip()
-            except:
-                insight = stdout or stderr or "Execution completed"
+{stderr[:COTAS_OUTPUT_CHARS] if stderr else "(no errors)"}"""
             
-            last_output = insight
-            
-            yield json.dumps({
+            pending_act = {
                 "type": "act_complete",
                 "step": step,
                 "stdout": stdout,
                 "stderr": stderr,
-                "insight": insight,
+                # Shown as-is if the run ends before another decision supplies the insight
+                "insight": stdout or stderr or "Execution completed",
                 "context_updated": context_update is not None
-            })
+            }
         
         elif action == "DONE":
             entry = {
@@ -337,30 +469,34 @@ Respond with only the insight text, no formatting."""
             with open(final_insight_path, "w", encoding="utf-8") as f:
                 f.write(content)
             
-            yield json.dumps({
+            yield {
                 "type": "done",
                 "step": step,
                 "final_insight": content
-            })
+            }
             break
         
         else:
-            yield json.dumps({
+            yield {
                 "type": "error",
                 "step": step,
                 "message": f"Unknown action: {action}"
-            })
+            }
             break
     
+    if pending_act is not None:
+        yield pending_act
+    
     if not cotas_log.get("completed"):
         cotas_log["end_time"] = int(time.time())
         cotas_log["completed"] = False
-        cotas_log["reason"] = "Max loops reached"
+        cotas_log["reason"] = "Client disconnected" if cancel is not None and cancel.is_set() else "Max loops reached"
     
+    cotas_log["duration_seconds"] = round(time.perf_counter() - started, 3)
     write_context(paths["cotas_log"], cotas_log)
     
-    yield json.dumps({
+    yield {
         "type": "complete",
         "total_steps": step,
         "log_saved": True
-    })
+    }
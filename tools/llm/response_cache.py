@@ -0,0 +1,36 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+MAX_CACHED_RESPONSES = 256
+
+_responses: "OrderedDict[str, str]" = OrderedDict()
+_responses_lock = threading.Lock()
+
+
+def cache_key(*parts: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        # Separator keeps ("ab", "c") and ("a", "bc") from colliding
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def cached_generate(key: str, fn: Callable[[], str]) -> str:
+    with _responses_lock:
+        if key in _responses:
+            _responses.move_to_end(key)
+            return _responses[key]
+
+    # Call outside the lock so a slow model request doesn't serialize every session
+    text = fn()
+
+    with _responses_lock:
+        _responses[key] = text
+        _responses.move_to_end(key)
+        while len(_responses) > MAX_CACHED_RESPONSES:
+            _responses.popitem(last=False)
+
+    return text
@@ -0,0 +1,9 @@
+# Imported once by the script fork server (see sandbox.py). Forked scripts inherit
+# these modules already loaded, with matplotlib on the headless Agg backend.
+import os
+
+os.environ["MPLBACKEND"] = "Agg"
+
+import numpy  # noqa: E402,F401
+import pandas  # noqa: E402,F401
+import matplotlib.pyplot  # noqa: E402,F401
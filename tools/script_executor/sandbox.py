@@ -1,10 +1,188 @@
+import hashlib
+import multiprocessing
+import re
+import runpy
+import signal
 import subprocess
 import tempfile
+import threading
+import time
+import traceback
 import os
 import sys
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
 
 DEFAULT_TIMEOUT = 30
 MAX_OUTPUT_CHARS = 50000
+# Past this much spooled output a script is printing in a loop; stop it instead of filling the disk
+MAX_OUTPUT_BYTES = 16 * 1024 * 1024
+OUTPUT_POLL_INTERVAL = 0.25
+# Data-segment cap (RLIMIT_DATA) for a forked script, so a runaway DataFrame fails with
+# MemoryError instead of pushing the server into the OOM killer; 0 disables it. Unlike
+# RLIMIT_AS it ignores reserved-but-unused address space (library mappings, the
+# per-thread malloc arenas pyarrow spins up), so it tracks what the script really allocates
+SCRIPT_MEMORY_LIMIT = int(os.getenv("SCRIPT_MEMORY_LIMIT_MB", "4096")) * 1024 * 1024
+
+# Scripts run headless: Agg skips GUI backend probing at import and makes plt.show() a no-op
+SCRIPT_ENV = {**os.environ, "MPLBACKEND": "Agg"}
+
+# Imported once by the fork server; every script is then forked from that warm process
+# instead of starting a fresh interpreter and importing pandas/matplotlib itself
+PRELOAD_MODULE = "tools.script_executor.preload"
+
+MAX_CACHED_RESULTS = 128
+# Scripts that can print something different on an identical rerun always execute
+_NONDETERMINISTIC = re.compile(
+    r"\b(?:import|from)\s+(?:random|secrets|uuid|time|requests|urllib|socket|subprocess)\b"
+    r"|datetime\.(?:now|today|utcnow)\b|np\.random\b|\.sample\(|pip\s+install"
+)
+
+_results: "OrderedDict[str, dict]" = OrderedDict()
+_results_lock = threading.Lock()
+
+_fork_context = None
+_fork_context_lock = threading.Lock()
+
+
+def _get_fork_context():
+    global _fork_context
+    with _fork_context_lock:
+        if _fork_context is None:
+            # No fork server on Windows; scripts fall back to a plain subprocess there
+            if "forkserver" not in multiprocessing.get_all_start_methods():
+                return None
+            context = multiprocessing.get_context("forkserver")
+            # Children import the parent's main module as __mp_main__ unless the fork
+            # server already holds it; preloading it keeps that off the per-script path
+            context.set_forkserver_preload(["__main__", PRELOAD_MODULE])
+            _fork_context = context
+    return _fork_context
+
+
+def _exec_forked(script_path: str, stdout_path: str, stderr_path: str, cwd: str) -> None:
+    # Runs in a fresh fork of the fork server, so nothing a script does (globals,
+    # chdir, sys.exit, a crash) outlives it or reaches the next one
+    import resource
+
+    # No CPU-time limit: it sums over threads, so multithreaded pyarrow/pandas would hit
+    # it long before the wall-clock timeout that _supervise already enforces
+    if SCRIPT_MEMORY_LIMIT:
+        resource.setrlimit(resource.RLIMIT_DATA, (SCRIPT_MEMORY_LIMIT, SCRIPT_MEMORY_LIMIT))
+
+    with open(stdout_path, "wb") as out, open(stderr_path, "wb") as err:
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+    os.chdir(cwd)
+    sys.argv = [script_path]
+    sys.path[0] = os.path.dirname(script_path)
+
+    code = 0
+    try:
+        runpy.run_path(script_path, run_name="__main__")
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            code = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException as e:
+        # Start the traceback at the script's own frames, as `python script.py` would
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != script_path:
+            tb = tb.tb_next
+        traceback.print_exception(type(e), e, tb or e.__traceback__)
+        code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _supervise(finished: Callable[[float], bool], kill: Callable[[], None], timeout: int, output_paths: Tuple[str, ...]) -> bool:
+    # Output is spooled to files rather than pipes, so memory stays flat however much a
+    # script prints; a script that keeps printing past MAX_OUTPUT_BYTES is stopped early
+    deadline = time.monotonic() + timeout
+    while not finished(max(0.0, min(OUTPUT_POLL_INTERVAL, deadline - time.monotonic()))):
+        if time.monotonic() >= deadline:
+            kill()
+            raise subprocess.TimeoutExpired("script", timeout)
+        if sum(_size(path) for path in output_paths) > MAX_OUTPUT_BYTES:
+            kill()
+            return True
+    return False
+
+
+def _run_forked(context, script_path: str, stdout_path: str, stderr_path: str, timeout: int) -> Tuple[Optional[int], bool]:
+    process = context.Process(
+        target=_exec_forked,
+        args=(script_path, stdout_path, stderr_path, os.getcwd()),
+        daemon=True
+    )
+    process.start()
+
+    def finished(wait: float) -> bool:
+        process.join(wait)
+        return process.exitcode is not None
+
+    def kill() -> None:
+        process.kill()
+        process.join()
+
+    overflowed = _supervise(finished, kill, timeout, (stdout_path, stderr_path))
+    return process.exitcode, overflowed
+
+
+def _run_subprocess(script_path: str, stdout_path: str, stderr_path: str, timeout: int) -> Tuple[Optional[int], bool]:
+    with open(stdout_path, "wb") as out, open(stderr_path, "wb") as err:
+        process = subprocess.Popen(
+            [sys.executable, script_path],
+            stdin=subprocess.DEVNULL,
+            stdout=out,
+            stderr=err,
+            cwd=os.getcwd(),
+            env=SCRIPT_ENV
+        )
+
+    def finished(wait: float) -> bool:
+        try:
+            process.wait(wait)
+        except subprocess.TimeoutExpired:
+            return False
+        return True
+
+    def kill() -> None:
+        process.kill()
+        process.wait()
+
+    overflowed = _supervise(finished, kill, timeout, (stdout_path, stderr_path))
+    return process.returncode, overflowed
+
+
+def _signal_note(returncode: int) -> str:
+    # A negative return code means the script died from a signal and printed nothing about it
+    try:
+        name = signal.Signals(-returncode).name
+    except ValueError:
+        name = f"signal {-returncode}"
+    hint = ""
+    if -returncode == signal.SIGKILL:
+        hint = f" (likely out of memory; the limit is SCRIPT_MEMORY_LIMIT_MB={SCRIPT_MEMORY_LIMIT // (1024 * 1024)})"
+    return f"\n... [Script terminated by {name}{hint}]"
+
+
+def _read_capped(path: str) -> str:
+    # One character past the cap is enough to know the output was truncated
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read(MAX_OUTPUT_CHARS + 1)
+
 
 def run_script_safely(code: str, timeout: int = DEFAULT_TIMEOUT) -> dict:
     with tempfile.NamedTemporaryFile(
@@ -15,29 +193,34 @@ def run_script_safely(code: str, timeout: int = DEFAULT_TIMEOUT) -> dict:
     ) as tmp:
         tmp.write(code)
         tmp_path = tmp.name
+    stdout_path = tmp_path + ".out"
+    stderr_path = tmp_path + ".err"
 
     try:
-        result = subprocess.run(
-            [sys.executable, tmp_path],
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-            check=False,
-            cwd=os.getcwd()
-        )
+        context = _get_fork_context()
+        if context is not None:
+            returncode, overflowed = _run_forked(context, tmp_path, stdout_path, stderr_path, timeout)
+        else:
+            returncode, overflowed = _run_subprocess(tmp_path, stdout_path, stderr_path, timeout)
         
-        stdout = (result.stdout or "")[:MAX_OUTPUT_CHARS]
-        stderr = (result.stderr or "")[:MAX_OUTPUT_CHARS]
+        raw_stdout = _read_capped(stdout_path)
+        raw_stderr = _read_capped(stderr_path)
+        stdout = raw_stdout[:MAX_OUTPUT_CHARS]
+        stderr = raw_stderr[:MAX_OUTPUT_CHARS]
         
-        if len(result.stdout or "") > MAX_OUTPUT_CHARS:
+        if len(raw_stdout) > MAX_OUTPUT_CHARS:
             stdout += f"\n... [Output truncated at {MAX_OUTPUT_CHARS} characters]"
-        if len(result.stderr or "") > MAX_OUTPUT_CHARS:
+        if len(raw_stderr) > MAX_OUTPUT_CHARS:
             stderr += f"\n... [Error output truncated at {MAX_OUTPUT_CHARS} characters]"
+        if overflowed:
+            stderr += f"\n... [Killed: output exceeded {MAX_OUTPUT_BYTES} bytes]"
+        elif returncode is not None and returncode < 0:
+            stderr += _signal_note(returncode)
         
         return {
             "stdout": stdout,
             "stderr": stderr,
-            "returncode": result.returncode
+            "returncode": returncode
         }
         
     except subprocess.TimeoutExpired:
@@ -55,7 +238,50 @@ def run_script_safely(code: str, timeout: int = DEFAULT_TIMEOUT) -> dict:
         }
         
     finally:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
\ No newline at end of file
+        for path in (tmp_path, stdout_path, stderr_path):
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+
+
+def directory_fingerprint(directory: str) -> str:
+    # Name, size and mtime of every file, so replacing or re-uploading a dataset
+    # changes the fingerprint without hashing file contents
+    try:
+        entries = sorted(
+            (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+            for entry in os.scandir(directory)
+            if entry.is_file()
+        )
+    except OSError:
+        return ""
+    return repr(entries)
+
+
+def run_script_cached(code: str, fingerprint: str, timeout: int = DEFAULT_TIMEOUT) -> dict:
+    if _NONDETERMINISTIC.search(code):
+        return run_script_safely(code, timeout)
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(code.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(fingerprint.encode("utf-8"))
+    key = digest.hexdigest()
+
+    with _results_lock:
+        if key in _results:
+            _results.move_to_end(key)
+            return dict(_results[key])
+
+    result = run_script_safely(code, timeout)
+
+    # Failures may be transient (timeouts, a file still being written); only cache clean runs
+    if result["returncode"] == 0:
+        with _results_lock:
+            _results[key] = dict(result)
+            _results.move_to_end(key)
+            while len(_results) > MAX_CACHED_RESULTS:
+                _results.popitem(last=False)
+
+    return result
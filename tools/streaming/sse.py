@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+import zlib
+from typing import Any, Iterable, Iterator, Optional
+
+import orjson
+
+BATCH_WINDOW = 0.05
+MAX_BATCH = 16
+QUEUE_SIZE = 32
+PUT_POLL_INTERVAL = 0.5
+GZIP_LEVEL = 6
+KEEPALIVE_INTERVAL = 15
+RETRY_MS = 5000
+
+_DONE = object()
+
+
+def _payload(update: Any) -> str:
+    # Producers hand over either JSON text or plain dicts (CoTAS yields dicts so each
+    # event is encoded exactly once, here); a dict never reaches the wire as its repr
+    if isinstance(update, str):
+        return update
+    return orjson.dumps(update).decode()
+
+
+def stream_events(updates: Iterable[Any], window: float = BATCH_WINDOW, max_batch: int = MAX_BATCH, stop: Optional[threading.Event] = None) -> Iterator[str]:
+    # Bounded so a slow client blocks the producer instead of piling up updates in memory
+    q = queue.Queue(maxsize=QUEUE_SIZE)
+    # A caller-supplied stop event is shared with the producer's own loop (e.g. CoTAS):
+    # once it is set, remaining updates are discarded while the producer winds down
+    # cleanly. Without one, the producer is simply closed.
+    owns_stop = stop is None
+    stop = stop or threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=PUT_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for update in updates:
+                if not put(_payload(update)) and owns_stop:
+                    break
+        except Exception as e:
+            put(_payload({"error": f"Analysis failed: {str(e)}"}))
+        finally:
+            close = getattr(updates, "close", None)
+            if close:
+                close()
+            put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+
+        done = False
+        while not done:
+            try:
+                batch = [q.get(timeout=KEEPALIVE_INTERVAL)]
+            except queue.Empty:
+                # Comment frame: invisible to clients, but keeps proxies from timing out the stream
+                yield ": keepalive\n\n"
+                continue
+            deadline = time.monotonic() + window
+
+            while batch[-1] is not _DONE and len(batch) < max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if batch[-1] is _DONE:
+                batch.pop()
+                done = True
+
+            if batch:
+                yield "data: " + "\ndata: ".join(batch) + "\n\n"
+    finally:
+        # Client went away (GeneratorExit) or stream finished: release the producer
+        stop.set()
+
+
+def gzip_events(events: Iterator[str], level: int = GZIP_LEVEL) -> Iterator[bytes]:
+    # Sync-flush after every event so each one reaches the browser immediately
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    try:
+        for event in events:
+            yield compressor.compress(event.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        close = getattr(events, "close", None)
+        if close:
+            close()
@@ -0,0 +1,103 @@
+import os
+import re
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+from tools.context_management.context_handler import read_context, write_context
+
+MAX_WORKERS = 4
+# Finished jobs' status files are removed once they've been left unpolled this long
+JOB_STATUS_TTL_SECONDS = 24 * 60 * 60
+
+_JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def _gevent_active() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+# Under gevent workers jobs run as greenlets: grpc's gevent integration only completes
+# Gemini calls made from the hub's thread, so they can't live in the native threadpool.
+# The CPU-bound parse inside a job is pushed to that threadpool with run_blocking instead.
+if _gevent_active():
+    import gevent
+    from gevent.lock import BoundedSemaphore
+
+    _job_slots = BoundedSemaphore(MAX_WORKERS)
+
+    def _start(fn: Callable[..., Any], *args) -> None:
+        def run():
+            with _job_slots:
+                fn(*args)
+        gevent.spawn(run)
+else:
+    from concurrent.futures import ThreadPoolExecutor
+
+    _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="concore-job")
+    _start = _executor.submit
+
+
+def run_blocking(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    # Disk reads/writes don't yield to the gevent hub; push them onto its native
+    # threadpool. Outside gevent each request already owns a thread, so call inline.
+    if not _gevent_active():
+        return fn(*args, **kwargs)
+
+    from gevent import get_hub
+    return get_hub().threadpool.apply(fn, args, kwargs)
+
+
+def _status_path(status_dir: str, job_id: str) -> str:
+    return os.path.join(status_dir, f"{job_id}.json")
+
+
+def _run_and_record(status_path: str, job_id: str, fn: Callable[..., Any], args, kwargs) -> Any:
+    # The outcome is written by the job itself, so nothing has to wait on it
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        write_context(status_path, {"job_id": job_id, "status": "failed", "error": str(e)})
+        raise
+    write_context(status_path, {"job_id": job_id, "status": "done", "result": result})
+    return result
+
+
+def _prune_finished_jobs(status_dir: str) -> None:
+    # The last write to a status file records the outcome, so its mtime is when the job
+    # finished; files still saying "processing" are left alone
+    cutoff = time.time() - JOB_STATUS_TTL_SECONDS
+    try:
+        with os.scandir(status_dir) as entries:
+            old = [entry.path for entry in entries
+                   if _JOB_ID.fullmatch(os.path.splitext(entry.name)[0]) and entry.stat().st_mtime < cutoff]
+    except FileNotFoundError:
+        return
+    for path in old:
+        if read_context(path).get("status") in ("done", "failed"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def submit_job(status_dir: str, fn: Callable[..., Any], *args, **kwargs) -> str:
+    # Status lives on disk rather than in this process's memory, so a poll that lands on
+    # another gunicorn worker (or comes in after a restart) still finds the job
+    _prune_finished_jobs(status_dir)
+    job_id = uuid.uuid4().hex
+    status_path = _status_path(status_dir, job_id)
+    write_context(status_path, {"job_id": job_id, "status": "processing"})
+    _start(_run_and_record, status_path, job_id, fn, args, kwargs)
+    return job_id
+
+
+def job_status(status_dir: str, job_id: str) -> Optional[Dict[str, Any]]:
+    # Job ids are uuid4 hex; anything else never names a status file
+    if not _JOB_ID.fullmatch(job_id):
+        return None
+    return read_context(_status_path(status_dir, job_id)) or None
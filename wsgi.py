@@ -0,0 +1,19 @@
+# Production entrypoint. Patch the stdlib before anything else is imported so
+# every SSE generator runs as a greenlet instead of pinning an OS thread:
+#
+#   gunicorn wsgi:application    (settings in gunicorn.conf.py)
+#
+# In production run it behind an HTTP/2-terminating proxy (deploy/nginx.conf).
+from gevent import monkey
+
+monkey.patch_all()
+
+# Gemini calls go over gRPC, whose C core blocks the hub while it waits on the
+# network; let its completion queue yield so other requests run during a call.
+import grpc.experimental.gevent as grpc_gevent  # noqa: E402
+
+grpc_gevent.init_gevent()
+
+from app import app  # noqa: E402
+
+application = app